@@ -4,13 +4,14 @@ import json
 import logging
 import os
 import socket
+import sqlite3
 import subprocess
 import threading
 import time
 from xml.etree import ElementTree
 # end stdlib
 import requests
-from flask import Flask
+from flask import Flask, request
 from flask_wtf.csrf import CSRFProtect
 import pytz
 import pyemvue
@@ -59,6 +60,18 @@ HEADERS  = {
     "Authorization": f"Bearer {HA_TOKEN}",
     "content-type": "application/json"
     }
+# Numeric samples are kept on disk in an embedded SQLite file next to keys.json.
+# Each tier is (table, bucket size in seconds, retention in seconds). Raw samples are not bucketed
+# and are keyed in milliseconds so two samples in the same second are both kept.
+METRICS_DB = os.getenv('METRICS_DB', 'metrics.db')
+METRIC_TIERS = [
+    ('metrics_raw', None, 24 * 3600),
+    ('metrics_1m', 60, 30 * 24 * 3600),
+    ('metrics_1h', 3600, 365 * 24 * 3600),
+    ]
+METRIC_RETENTION_INTERVAL = 3600
+# Roughly three hours of samples at the current collector rate; older samples are dropped while writes keep failing.
+METRICS_BUFFER_MAX = 20000
 
 ## Init
 # Pull current time and timezone.
@@ -95,6 +108,13 @@ sabnzbd = {}
 router  = {}
 router['router_updates'] = 0
 poll_world_weather = True
+metrics_buffer = []
+metrics_lock = threading.Lock()
+metrics_db = None
+metrics_db_lock = threading.Lock()
+metrics_ids = {}
+metrics_last_retention = 0
+metrics_dropping = False
 
 ### Global Functions
 def start_threads():
@@ -117,6 +137,9 @@ def start_threads():
         prthread.start()
         routhread = threading.Thread(target=refresh_router_updates)
         routhread.start()
+        # Write out whatever the collectors recorded since the last pass.
+        metthread = threading.Thread(target=flush_metrics)
+        metthread.start()
         # Check if it has been at least 900 seconds since last we refreshed world weather.
         # Or if this is the first run since app launch then refresh world weather.
         now = datetime.datetime.now()
@@ -133,6 +156,137 @@ def start_threads():
         # Wait 5 seconds before repeating the loop.
         time.sleep(5)
 
+def init_metric_store():
+    global metrics_db
+    log.info(f'Opening metric store at {METRICS_DB}.')
+    try:
+        db = sqlite3.connect(METRICS_DB, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS metric_names (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL)')
+        db.execute('CREATE TABLE IF NOT EXISTS metrics_raw (metric_id INTEGER, ts INTEGER, value REAL, '
+                   'PRIMARY KEY (metric_id, ts)) WITHOUT ROWID')
+        for table, bucket, retention in METRIC_TIERS:
+            if bucket is None:
+                continue
+            db.execute(f'CREATE TABLE IF NOT EXISTS {table} (metric_id INTEGER, ts INTEGER, samples INTEGER, '
+                       'total REAL, low REAL, high REAL, PRIMARY KEY (metric_id, ts)) WITHOUT ROWID')
+        db.commit()
+        ids = dict(db.execute('SELECT name, id FROM metric_names'))
+    except sqlite3.Error as e:
+        # Leave metrics_db unset so the rest of statd runs with the store disabled.
+        log.error(f'Failed to open metric store at {METRICS_DB}, metrics will not be recorded: {e}')
+        return
+    metrics_ids.update(ids)
+    metrics_db = db
+
+def record_metric(name, value):
+    # Collectors call this from their own threads; samples are held in memory until the next flush.
+    if metrics_db is None:
+        return
+    with metrics_lock:
+        metrics_buffer.append((name, int(time.time() * 1000), float(value)))
+
+def get_metric_id(name):
+    # Callers must hold metrics_db_lock.
+    if name not in metrics_ids:
+        cur = metrics_db.execute('INSERT OR IGNORE INTO metric_names (name) VALUES (?)', (name,))
+        if cur.lastrowid and cur.rowcount:
+            metrics_ids[name] = cur.lastrowid
+        else:
+            metrics_ids[name] = metrics_db.execute('SELECT id FROM metric_names WHERE name = ?', (name,)).fetchone()[0]
+    return metrics_ids[name]
+
+def flush_metrics():
+    global metrics_last_retention, metrics_dropping
+    if metrics_db is None:
+        return
+    # metrics_lock only guards the buffer so collectors never wait on disk I/O.
+    # metrics_db_lock serialises everything that touches the connection or metrics_ids.
+    with metrics_db_lock:
+        with metrics_lock:
+            if not metrics_buffer:
+                return
+            batch = metrics_buffer[:]
+            metrics_buffer.clear()
+        new_names = {name for name, ts, value in batch if name not in metrics_ids}
+        # Append the batch to the raw tier and fold it into every rollup tier in one transaction.
+        try:
+            with metrics_db:
+                # Key on (metric_id, ts) so raw and the rollups see exactly the same samples.
+                rows = {(get_metric_id(name), ts): value for name, ts, value in batch}
+                rows = [(metric_id, ts, value) for (metric_id, ts), value in rows.items()]
+                metrics_db.executemany('INSERT OR REPLACE INTO metrics_raw (metric_id, ts, value) VALUES (?, ?, ?)', rows)
+                for table, bucket, retention in METRIC_TIERS:
+                    if bucket is None:
+                        continue
+                    metrics_db.executemany(
+                        f'INSERT INTO {table} (metric_id, ts, samples, total, low, high) VALUES (?, ?, 1, ?, ?, ?) '
+                        'ON CONFLICT (metric_id, ts) DO UPDATE SET samples = samples + 1, total = total + excluded.total, '
+                        'low = min(low, excluded.low), high = max(high, excluded.high)',
+                        [(metric_id, ts // 1000 - ts // 1000 % bucket, value, value, value) for metric_id, ts, value in rows])
+        except sqlite3.Error as e:
+            # Names registered inside the rolled back transaction no longer exist on disk.
+            for name in new_names:
+                metrics_ids.pop(name, None)
+            # Put the batch back ahead of anything recorded since, to be retried next pass.
+            # Past METRICS_BUFFER_MAX the oldest samples are dropped, warning once per run of failures.
+            with metrics_lock:
+                metrics_buffer[:0] = batch
+                overflow = len(metrics_buffer) - METRICS_BUFFER_MAX
+                if overflow > 0:
+                    del metrics_buffer[:overflow]
+            log.error(f'Failed to write {len(batch)} metric samples, will retry next pass: {e}')
+            if overflow > 0 and not metrics_dropping:
+                metrics_dropping = True
+                log.warning('Metric buffer is full, dropping the oldest samples until writes succeed.')
+            return
+        metrics_dropping = False
+        log.debug(f'Flushed {len(rows)} metric samples.')
+        # Enforce retention at most once per METRIC_RETENTION_INTERVAL.
+        now = int(time.time())
+        if now - metrics_last_retention < METRIC_RETENTION_INTERVAL:
+            return
+        metrics_last_retention = now
+        try:
+            with metrics_db:
+                for table, bucket, retention in METRIC_TIERS:
+                    cutoff = now - retention
+                    if bucket is None:
+                        cutoff *= 1000
+                    metrics_db.executemany(f'DELETE FROM {table} WHERE metric_id = ? AND ts < ?',
+                                           [(metric_id, cutoff) for metric_id in metrics_ids.values()])
+        except sqlite3.Error as e:
+            log.error(f'Failed to enforce metric retention: {e}')
+
+def query_metric(name, start, end=None, step=None):
+    # Return [ts, avg, min, max] points for name between start and end (epoch seconds).
+    # The finest tier whose retention still covers start is used, and step (seconds) buckets the result further.
+    now = int(time.time())
+    if end is None:
+        end = now
+    for table, bucket, retention in METRIC_TIERS:
+        if start >= now - retention:
+            break
+    if not step or step < 1:
+        step = bucket or 1
+    if bucket is None:
+        seconds = 'ts / 1000'
+        scale = 1000
+        select = 'AVG(value), MIN(value), MAX(value)'
+    else:
+        seconds = 'ts'
+        scale = 1
+        select = 'SUM(total) / SUM(samples), MIN(low), MAX(high)'
+    with metrics_db_lock:
+        if metrics_db is None or name not in metrics_ids:
+            return table, []
+        rows = metrics_db.execute(
+            f'SELECT {seconds} - {seconds} % ? AS bucket, {select} FROM {table} '
+            'WHERE metric_id = ? AND ts >= ? AND ts < ? GROUP BY bucket ORDER BY bucket',
+            (step, metrics_ids[name], start * scale, (end + 1) * scale)).fetchall()
+    return table, [list(row) for row in rows]
+
 def convert_to_central_time(utc_string):
     utc_time = datetime.datetime.fromisoformat(utc_string)
     chicago = pytz.timezone('America/Chicago')
@@ -180,6 +334,52 @@ def calc_wind_arrow(bearing):
     elif dir == 'Southwest':
         return '\u2199'
 
+def iter_xml_stream(resp, chunk_size=16384, max_depth=None):
+    # Feed the response body to a pull parser as it arrives rather than building the whole tree first.
+    # Yields (event, element, depth) where the document root is depth 1.
+    # Events deeper than max_depth are only counted, never yielded.
+    # Once the caller has seen the end of a root child it is cleared and detached from the root to free it.
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    depth = 0
+    if max_depth is None:
+        max_depth = float('inf')
+
+    def drain():
+        nonlocal root, depth
+        for event, elem in parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = elem
+                if depth <= max_depth:
+                    yield event, elem, depth
+            else:
+                if depth <= max_depth:
+                    yield event, elem, depth
+                if depth == 2:
+                    elem.clear()
+                    root.remove(elem)
+                depth -= 1
+
+    for chunk in resp.iter_content(chunk_size=chunk_size):
+        parser.feed(chunk)
+        yield from drain()
+    # Only reached when the caller read the whole body, so a truncated or empty body raises ParseError here.
+    parser.close()
+    yield from drain()
+
+def find_log_line(text, marker):
+    # Return the last line of text containing marker without splitting the whole string.
+    idx = text.rfind(marker)
+    if idx == -1:
+        return None
+    start = text.rfind('\n', 0, idx) + 1
+    end = text.find('\n', idx)
+    if end == -1:
+        end = len(text)
+    return text[start:end]
+
 def refresh_worldweather():
     # Abort the function if the global toggle is disabled.
     global poll_world_weather
@@ -191,89 +391,83 @@ def refresh_worldweather():
     # Prepare and send the API request.
     zipcode = 63021
     url = f'https://api.worldweatheronline.com/premium/v1/weather.ashx?key={WEATHER_TOKEN}&q={zipcode}'
-    resp = requests.request('GET', url)
-
-    # Catch and handle the 429 condition.
-    if resp.status_code == 429:
-        log.error('WorldWeather API calls used up for the day.')
-        poll_world_weather = False
-        return
-
-    # Extract the relevant detail from the XML data.
-    xml_data = ElementTree.fromstring(resp.text)
-    weather['timestamp'] = datetime.datetime.now().isoformat().split('.')[0]
-    weather['today_date'] = weather['timestamp'].split('T')[0]
-    tomorrow_timestamp = datetime.datetime.now() + datetime.timedelta(days=1)
-    weather['tomorrow_timestamp'] = tomorrow_timestamp.isoformat().split('.')[0]
-    weather['tomorrow_date'] = weather['tomorrow_timestamp'].split('T')[0]
-    plus_2_timestamp = datetime.datetime.now() + datetime.timedelta(days=2)
-    weather['plus_2_timestamp'] = plus_2_timestamp.isoformat().split('.')[0]
-    weather['plus_2_date'] = weather['plus_2_timestamp'].split('T')[0]
-    plus_3_timestamp = datetime.datetime.now() + datetime.timedelta(days=3)
-    weather['plus_3_timestamp'] = plus_3_timestamp.isoformat().split('.')[0]
-    weather['plus_3_date'] = weather['plus_3_timestamp'].split('T')[0]
-    for branch in xml_data:
-        if branch.tag == 'current_condition':
-            for branch_l2 in branch:
-                if branch_l2.tag == 'temp_F':
-                    weather['now_temp_f'] = branch_l2.text
-                if branch_l2.tag == 'weatherDesc':
-                    weather['weather_desc'] = branch_l2.text
-                if branch_l2.tag == 'windspeedMiles':
-                    weather['wind_speed_mph'] = branch_l2.text
-                if branch_l2.tag == 'winddir16Point':
-                    weather['wind_dir'] = branch_l2.text
-                if branch_l2.tag == 'precipInches':
-                    weather['precip_inches'] = branch_l2.text
-                if branch_l2.tag == 'humidity':
-                    weather['humidity'] = branch_l2.text
-                if branch_l2.tag == 'FeelsLikeF':
-                    weather['feels_like_f'] = branch_l2.text
-                if branch_l2.tag == 'pressureInches':
-                    weather['pressure_inches'] = branch_l2.text
-                if branch_l2.tag == 'cloudcover':
-                    weather['cloud_cover'] = branch_l2.text
-                if branch_l2.tag == 'uvIndex':
-                    weather['uv_index'] = branch_l2.text
-        if branch.tag == 'weather':
-            for branch_l2 in branch:
-                if branch_l2.tag == 'date' and branch_l2.text == weather['today_date']:
-                    today_weather = branch
-                elif branch_l2.tag == 'date' and branch_l2.text == weather['tomorrow_date']:
-                    tomorrow_weather = branch
-                elif branch_l2.tag == 'date' and branch_l2.text == weather['plus_2_date']:
-                    plus_2_weather = branch
-                elif branch_l2.tag == 'date' and branch_l2.text == weather['plus_3_date']:
-                    plus_3_weather = branch
-    for branch in today_weather:
-        if branch.tag == 'mintempF':
-            weather['today_low_temp'] = branch.text
-        if branch.tag == 'maxtempF':
-            weather['today_high_temp'] = branch.text
-        if branch.tag == 'sunHour':
-            weather['today_sunhours'] = branch.text
-    for branch in tomorrow_weather:
-        if branch.tag == 'mintempF':
-            weather['tomorrow_low_temp'] = branch.text
-        if branch.tag == 'maxtempF':
-            weather['tomorrow_high_temp'] = branch.text
-        if branch.tag == 'sunHour':
-            weather['tomorrow_sunhours'] = branch.text
-    for branch in plus_2_weather:
-        if branch.tag == 'mintempF':
-            weather['plus_2_low_temp'] = branch.text
-        if branch.tag == 'maxtempF':
-            weather['plus_2_high_temp'] = branch.text
-        if branch.tag == 'sunHour':
-            weather['plus_2_sunhours'] = branch.text
-    for branch in plus_3_weather:
-        if branch.tag == 'mintempF':
-            weather['plus_3_low_temp'] = branch.text
-        if branch.tag == 'maxtempF':
-            weather['plus_3_high_temp'] = branch.text
-        if branch.tag == 'sunHour':
-            weather['plus_3_sunhours'] = branch.text
-
+    with requests.request('GET', url, stream=True) as resp:
+
+        # Catch and handle the 429 condition.
+        if resp.status_code == 429:
+            log.error('WorldWeather API calls used up for the day.')
+            poll_world_weather = False
+            return
+
+        # Collect everything locally and only publish it once the stream has been read without error,
+        # so a ParseError partway through leaves the previous timestamp and values untouched.
+        parsed = {}
+        parsed['timestamp'] = datetime.datetime.now().isoformat().split('.')[0]
+        parsed['today_date'] = parsed['timestamp'].split('T')[0]
+        tomorrow_timestamp = datetime.datetime.now() + datetime.timedelta(days=1)
+        parsed['tomorrow_timestamp'] = tomorrow_timestamp.isoformat().split('.')[0]
+        parsed['tomorrow_date'] = parsed['tomorrow_timestamp'].split('T')[0]
+        plus_2_timestamp = datetime.datetime.now() + datetime.timedelta(days=2)
+        parsed['plus_2_timestamp'] = plus_2_timestamp.isoformat().split('.')[0]
+        parsed['plus_2_date'] = parsed['plus_2_timestamp'].split('T')[0]
+        plus_3_timestamp = datetime.datetime.now() + datetime.timedelta(days=3)
+        parsed['plus_3_timestamp'] = plus_3_timestamp.isoformat().split('.')[0]
+        parsed['plus_3_date'] = parsed['plus_3_timestamp'].split('T')[0]
+
+        # Map the tags we care about to their keys in the weather dict.
+        current_tags = {
+            'temp_F': 'now_temp_f',
+            'weatherDesc': 'weather_desc',
+            'windspeedMiles': 'wind_speed_mph',
+            'winddir16Point': 'wind_dir',
+            'precipInches': 'precip_inches',
+            'humidity': 'humidity',
+            'FeelsLikeF': 'feels_like_f',
+            'pressureInches': 'pressure_inches',
+            'cloudcover': 'cloud_cover',
+            'uvIndex': 'uv_index',
+            }
+        day_tags = {
+            'mintempF': 'low_temp',
+            'maxtempF': 'high_temp',
+            'sunHour': 'sunhours',
+            }
+        day_prefixes = {
+            parsed['today_date']: 'today',
+            parsed['tomorrow_date']: 'tomorrow',
+            parsed['plus_2_date']: 'plus_2',
+            parsed['plus_3_date']: 'plus_3',
+            }
+
+        # Extract the relevant detail from the XML data as it streams in.
+        # Stop reading as soon as current conditions and all four days have been seen.
+        current_found = False
+        days_found = set()
+        for event, elem, depth in iter_xml_stream(resp, max_depth=3):
+            if event != 'end':
+                continue
+            # The hourly and astronomy blocks are never used so drop them as soon as they close.
+            if elem.tag in ('hourly', 'astronomy'):
+                elem.clear()
+                continue
+            if depth != 2:
+                continue
+            if elem.tag == 'current_condition':
+                for branch in elem:
+                    if branch.tag in current_tags:
+                        parsed[current_tags[branch.tag]] = branch.text
+                current_found = True
+            elif elem.tag == 'weather':
+                prefix = day_prefixes.get(elem.findtext('date'))
+                if prefix:
+                    for branch in elem:
+                        if branch.tag in day_tags:
+                            parsed[f'{prefix}_{day_tags[branch.tag]}'] = branch.text
+                    days_found.add(prefix)
+            if current_found and len(days_found) == len(day_prefixes):
+                break
+
+    weather.update(parsed)
     return weather
 
 def fetch_ha_states():
@@ -435,37 +629,43 @@ def refresh_plex_recently_added(PLEX_TOKEN):
     log.info('Refreshing plex recently added.')
     headers = {'X-Plex-Token': PLEX_TOKEN}
     try:
-        plex_recently_added_xml = requests.get(PLEX_API + 'library/sections/2/newest', headers=headers)
+        plex_recently_added_xml = requests.get(PLEX_API + 'library/sections/2/newest', headers=headers, stream=True)
     except ConnectionError:
         log.warning('Plex appears to be down.')
         return
-    tv_xml = ElementTree.fromstring(plex_recently_added_xml.text)
 
+    # Only the attributes on each item are needed, so read them at the start tag and let the
+    # nested Media/Part elements be discarded as soon as the item closes.
     tvshows = []
-    for item in tv_xml:
-        new_episode = {}
-        new_episode['season_name'] = item.attrib['parentTitle'].replace('Season ', 'S')
-        new_episode['episode_number'] = item.attrib['index']
-        if 'updatedAt' in item.attrib.keys():
-            new_episode['epoch_updated'] = item.attrib['updatedAt']
-        new_episode['epoch_added'] = item.attrib['addedAt']
-        new_episode['show_name'] = item.attrib['grandparentTitle']
-        tvshows.append(new_episode)
+    with plex_recently_added_xml:
+        for event, item, depth in iter_xml_stream(plex_recently_added_xml, max_depth=2):
+            if event != 'start' or depth != 2:
+                continue
+            new_episode = {}
+            new_episode['season_name'] = item.attrib['parentTitle'].replace('Season ', 'S')
+            new_episode['episode_number'] = item.attrib['index']
+            if 'updatedAt' in item.attrib.keys():
+                new_episode['epoch_updated'] = item.attrib['updatedAt']
+            new_episode['epoch_added'] = item.attrib['addedAt']
+            new_episode['show_name'] = item.attrib['grandparentTitle']
+            tvshows.append(new_episode)
 
     try:
-        plex_recently_added_xml = requests.get(PLEX_API + 'library/sections/1/newest', headers=headers)
+        plex_recently_added_xml = requests.get(PLEX_API + 'library/sections/1/newest', headers=headers, stream=True)
     except ConnectionError:
         log.warning('Connection to Plex failed.')
         return
-    movie_xml = ElementTree.fromstring(plex_recently_added_xml.text)
 
     movies = []
-    for item in movie_xml:
-        new_movie = {}
-        new_movie['title'] = item.attrib['title']
-        new_movie['year'] = item.attrib['year']
-        new_movie['epoch_added'] = item.attrib['addedAt']
-        movies.append(new_movie)
+    with plex_recently_added_xml:
+        for event, item, depth in iter_xml_stream(plex_recently_added_xml, max_depth=2):
+            if event != 'start' or depth != 2:
+                continue
+            new_movie = {}
+            new_movie['title'] = item.attrib['title']
+            new_movie['year'] = item.attrib['year']
+            new_movie['epoch_added'] = item.attrib['addedAt']
+            movies.append(new_movie)
 
     movies = sorted(movies, key=lambda d: d['epoch_added'], reverse=True)
     tvshows = sorted(tvshows, key=lambda d: d['epoch_added'], reverse=True)
@@ -505,42 +705,49 @@ def refresh_plex_streams(PLEX_TOKEN):
     log.info('Fetching stream states from plex.')
     headers = {'X-Plex-Token': PLEX_TOKEN}
     try:
-        plex_sessions_xml = requests.get(PLEX_API + 'status/sessions', headers=headers)
+        plex_sessions_xml = requests.get(PLEX_API + 'status/sessions', headers=headers, stream=True)
     except ConnectionError:
         log.warning('Plex appears to be down.')
         return
-    xml_tree = ElementTree.fromstring(plex_sessions_xml.text)
+
+    # Each session is a root child and the details we want sit on its direct children,
+    # so everything can be read from start tags without keeping the session subtree.
     streams = []
-    for stream in xml_tree:
-        stream_item = {}
-        stream_item['type'] = stream.attrib['type']
-        stream_item['title'] = stream.attrib['title']
-        if 'parentTitle' in stream.attrib.keys():
-            if stream_item['type'] == 'episode':
-                stream_item['season'] = stream.attrib['parentTitle']
-            elif stream_item['type'] == 'track':
-                stream_item['album'] = stream.attrib['parentTitle']
-        if 'grandparentTitle' in stream.attrib.keys():
-            if stream_item['type'] == 'episode':
-                stream_item['tv_show'] = stream.attrib['grandparentTitle']
-            elif stream_item['type'] == 'track':
-                stream_item['artist'] = stream.attrib['grandparentTitle']
-            else:
-                stream_item['grandparent'] = stream.attrib['grandparentTitle']
-        for child in stream:
-            if child.tag == 'User' and 'title' in child.attrib.keys():
-                stream_item['user'] = child.attrib['title']
-            if child.tag == 'Media' and 'videoResolution' in child.attrib.keys():
-                stream_item['video_resolution'] = child.attrib['videoResolution']
-            if child.tag == 'Session' and 'location' in child.attrib.keys():
-                stream_item['location'] = child.attrib['location']
-            if child.tag == 'Player' and 'state' in child.attrib.keys():
-                stream_item['state'] = child.attrib['state']
-            if child.tag == 'Player' and 'remotePublicAddress' in child.attrib.keys():
-                remote_ip = child.attrib['remotePublicAddress']
-                if '127.0.0.1' not in remote_ip and '192.168.' not in remote_ip:
-                    stream_item['ip'] = remote_ip
-        streams.append(stream_item)
+    with plex_sessions_xml:
+        for event, stream, depth in iter_xml_stream(plex_sessions_xml, max_depth=3):
+            if event != 'start':
+                continue
+            if depth == 2:
+                stream_item = {}
+                stream_item['type'] = stream.attrib['type']
+                stream_item['title'] = stream.attrib['title']
+                if 'parentTitle' in stream.attrib.keys():
+                    if stream_item['type'] == 'episode':
+                        stream_item['season'] = stream.attrib['parentTitle']
+                    elif stream_item['type'] == 'track':
+                        stream_item['album'] = stream.attrib['parentTitle']
+                if 'grandparentTitle' in stream.attrib.keys():
+                    if stream_item['type'] == 'episode':
+                        stream_item['tv_show'] = stream.attrib['grandparentTitle']
+                    elif stream_item['type'] == 'track':
+                        stream_item['artist'] = stream.attrib['grandparentTitle']
+                    else:
+                        stream_item['grandparent'] = stream.attrib['grandparentTitle']
+                streams.append(stream_item)
+            elif depth == 3:
+                child = stream
+                if child.tag == 'User' and 'title' in child.attrib.keys():
+                    stream_item['user'] = child.attrib['title']
+                if child.tag == 'Media' and 'videoResolution' in child.attrib.keys():
+                    stream_item['video_resolution'] = child.attrib['videoResolution']
+                if child.tag == 'Session' and 'location' in child.attrib.keys():
+                    stream_item['location'] = child.attrib['location']
+                if child.tag == 'Player' and 'state' in child.attrib.keys():
+                    stream_item['state'] = child.attrib['state']
+                if child.tag == 'Player' and 'remotePublicAddress' in child.attrib.keys():
+                    remote_ip = child.attrib['remotePublicAddress']
+                    if '127.0.0.1' not in remote_ip and '192.168.' not in remote_ip:
+                        stream_item['ip'] = remote_ip
     clean_streams = []
     for stream in streams:
         if stream['type'] == 'track':
@@ -575,6 +782,8 @@ def refresh_emporia_data():
     dryer_usage_watt  = dryer_usage_dict[dryer.device_gid].channels['1,2,3'].usage * 3600 * 1000
     emporia['Washer'] = str(round(washer_usage_watt, 1)) + 'W'
     emporia['Dryer']  = str(round(dryer_usage_watt, 1)) + 'W'
+    record_metric('emporia.washer_watts', washer_usage_watt)
+    record_metric('emporia.dryer_watts', dryer_usage_watt)
 
 def refresh_sabnzbd():
     url = f"http://nas.mccormicom.com:8081/api?apikey={SABNZBD_API_KEY}&output=json&mode=queue"
@@ -589,6 +798,8 @@ def refresh_sabnzbd():
     totalspace_tb                   = float(sab_queue['queue']['diskspacetotal1']) / 1000
     rounded_tb                      = round(totalspace_tb, 1)
     sabnzbd['sab_total_space']      = str(rounded_tb) + 'T'
+    record_metric('sabnzbd.free_space_gb', sab_queue['queue']['diskspace1'])
+    record_metric('sabnzbd.total_space_gb', sab_queue['queue']['diskspacetotal1'])
 
 def refresh_router_updates():
     log.info('Fetching Router data.')
@@ -602,12 +813,10 @@ def refresh_router_updates():
         return
 
     router['router_status'] = 'HEALTHY'
-    updates_found = False
-    for line in jd['log'].split('\n'):
-        if 'package(s) will be affected' in line:
-            updates_found = True
-            router['router_updates'] = line.split(' ')[2]
-    if not updates_found:
+    line = find_log_line(jd['log'], 'package(s) will be affected')
+    if line:
+        router['router_updates'] = line.split(' ')[2]
+    else:
         router['router_updates'] = "0"
 
     # Kick off a firmware upgrade check. It will take a minute but we'll parse the results next execution.
@@ -623,13 +832,15 @@ def refresh_router_updates():
         router['router_status'] = 'DOWN'
         return
 
-    bytes_transmitted = jd['interfaces']['wan']['bytes transmitted']
-    bytes_received    = jd['interfaces']['wan']['bytes received']
+    # The counters may arrive as strings, so cast once to keep the comparisons below numeric.
+    bytes_transmitted = int(jd['interfaces']['wan']['bytes transmitted'])
+    bytes_received    = int(jd['interfaces']['wan']['bytes received'])
 
     if 'bytes_transmitted' in router:
         if bytes_transmitted > router['bytes_transmitted']:
-            delta = int(bytes_transmitted) - int(router['bytes_transmitted'])
+            delta = bytes_transmitted - router['bytes_transmitted']
             delta = round(delta / 5, 2)
+            record_metric('router.outbound_bps', delta)
             if delta > 1000000:
                 unit = 'MBps'
                 delta = round(delta / 1000000, 2)
@@ -639,9 +850,13 @@ def refresh_router_updates():
             else:
                 unit = 'Bps'
             router['outbound_speed'] = str(delta) + unit
+        elif bytes_transmitted == router['bytes_transmitted']:
+            # No traffic still counts towards the averages; a lower counter means it reset, so skip it.
+            record_metric('router.outbound_bps', 0)
         if bytes_received > router['bytes_received']:
-            delta = int(bytes_received) - int(router['bytes_received'])
+            delta = bytes_received - router['bytes_received']
             delta = round(delta / 5, 2)
+            record_metric('router.inbound_bps', delta)
             if delta > 1000000:
                 unit = 'MBps'
                 delta = round(delta / 1000000, 2)
@@ -651,6 +866,8 @@ def refresh_router_updates():
             else:
                 unit = 'Bps'
             router['inbound_speed'] = str(delta) + unit
+        elif bytes_received == router['bytes_received']:
+            record_metric('router.inbound_bps', 0)
 
     router['bytes_transmitted'] = bytes_transmitted
     router['bytes_received'] = bytes_received
@@ -674,8 +891,32 @@ def states_all():
 def states_plex():
     return json.dumps(plex)
 
+@app.route('/metrics')
+def metrics_list():
+    with metrics_db_lock:
+        names = sorted(metrics_ids.keys())
+    return json.dumps(names)
+
+@app.route('/metrics/<name>')
+def metrics_range(name):
+    # Defaults to the last 24 hours at the finest resolution available.
+    end = request.args.get('end', type=int)
+    start = request.args.get('start', type=int)
+    step = request.args.get('step', type=int)
+    if end is None:
+        end = int(time.time())
+    if start is None:
+        start = end - 24 * 3600
+    resolution, points = query_metric(name, start, end, step)
+    resp = {}
+    resp['metric'] = name
+    resp['resolution'] = resolution
+    resp['points'] = points
+    return json.dumps(resp)
+
 ### Main
 if __name__ == "__main__":
+    init_metric_store()
     thread = threading.Thread(target=start_threads)
     thread.start()
     app.run(host='0.0.0.0')